@@ -16,7 +16,7 @@ import os
 from threading import Thread
 from time import sleep
 from constants import   LOCALHOST, BUFFER_SIZE, VALID_OPERATIONS, PROMPT, \
-                        SERVER_SUCCESS
+                        SERVER_SUCCESS, PRESENCE_HEADER
 
 if len(sys.argv) != 4:
     print(f"Usage: {sys.argv[0]} server_IP server_port client_udp_server_port")
@@ -64,20 +64,82 @@ def get_positive_int(prefix, name, string):
     
     return string
 
-# UDP listener thread to download files from peers
+# Active edge devices learnt from pushed presence events, mapping username to
+# its (IP, UDP port), only kept up to date while subscribed
+known_devices = {}
+presence_subscribed = False
+
+# IP address presence events are pushed from
+server_ip = client_socket.getpeername()[0]
+
+# Applies a batch of presence events pushed by the server to known_devices,
+# ignoring batches from anyone else or arriving while unsubscribed and dropping
+# malformed events
+def process_presence_events(data, sender):
+    if sender[0] != server_ip or not presence_subscribed:
+        return
+
+    print()
+    for event in data.decode(errors="replace").splitlines()[1:]:
+        try:
+            event, device_name, active_since, ip, udp_port = event.split("; ")
+            udp_port = int(udp_port)
+        except ValueError:
+            continue
+
+        if event == "join":
+            known_devices[device_name] = (ip, udp_port)
+            print(f"{device_name} joined, active since {active_since}. IP: {ip}, UDP port: {udp_port}.")
+        elif event == "leave":
+            known_devices.pop(device_name, None)
+            print(f"{device_name} left the edge network")
+    print(PROMPT)
+
+# Checks whether a datagram is a batch of presence events pushed by the server
+def is_presence_datagram(data):
+    return data.split(b"\n")[0] == PRESENCE_HEADER.encode()
+
+# Receives the next datagram sent by the peer at peer_address, handling any
+# presence events pushed in the meantime and dropping datagrams from others
+def receive_from_peer(peer_sock, peer_address):
+    while True:
+        data, sender = peer_sock.recvfrom(BUFFER_SIZE)
+
+        if sender == peer_address:
+            return data
+
+        if is_presence_datagram(data):
+            process_presence_events(data, sender)
+
+# UDP listener thread to download files from peers and receive presence events
+# from the server, using a single socket so no datagram is lost between them
 def peer_receiver_loop():
+    peer_sock = socket(AF_INET, SOCK_DGRAM)
+    try:
+        peer_sock.bind((LOCALHOST, client_udp_server_port))
+    except OSError:
+        print(f"Client UDP server port {client_udp_server_port} is already in use. Please choose another port")
+        os._exit(1)
+
     while True:
-        peer_sock = socket(AF_INET, SOCK_DGRAM)
-        try:
-            peer_sock.bind((LOCALHOST, client_udp_server_port))
-        except OSError:
-            print(f"Client UDP server port {client_udp_server_port} is already in use. Please choose another port")
-            os._exit(1)
-        
-        data, _ = peer_sock.recvfrom(BUFFER_SIZE)
+        peer_sock.settimeout(None)
+        data, peer_address = peer_sock.recvfrom(BUFFER_SIZE)
+
+        if is_presence_datagram(data):
+            process_presence_events(data, peer_address)
+            continue
+
         username = data.strip().decode()
 
-        data, _ = peer_sock.recvfrom(BUFFER_SIZE)
+        peer_sock.settimeout(2)
+        try:
+            data = receive_from_peer(peer_sock, peer_address)
+        except timeout:
+            print()
+            print(f"File transfer from {username} was interrupted")
+            print(PROMPT)
+            continue
+
         filename = data.strip().decode()
 
         new_filename = f"{username}_{filename}"
@@ -86,14 +148,13 @@ def peer_receiver_loop():
         print(f"File {filename} being received from someone")
 
         with open(new_filename, "wb") as f:
-            data, _ = peer_sock.recvfrom(BUFFER_SIZE)
             try:
+                data = receive_from_peer(peer_sock, peer_address)
                 while data:
                     f.write(data)
-                    peer_sock.settimeout(2)
-                    data, _ = peer_sock.recvfrom(BUFFER_SIZE)
+                    data = receive_from_peer(peer_sock, peer_address)
             except timeout:
-                peer_sock.close()
+                pass
         
         print(f"Saved file {filename} as {new_filename} from {username}")
         print(PROMPT)
@@ -103,26 +164,30 @@ listen_UDP = Thread(target=peer_receiver_loop)
 listen_UDP.setDaemon(True)
 listen_UDP.start()
 
-# Gets peer IP and UDP port from server and sends file directly to peer
+# Gets peer IP and UDP port (from presence events if subscribed, otherwise from
+# the server) and sends file directly to peer
 def send_file_to_peer(device_name, filename):
-    response = send_to_server(f"device address\n{device_name}").splitlines()
+    if presence_subscribed and device_name in known_devices:
+        host, port = known_devices[device_name]
+    else:
+        response = send_to_server(f"device address\n{device_name}").splitlines()
 
-    if response[0] == "device not found":
-        print(f"Device with name {device_name} does not exist")
-        return
-    
-    if response[0] == "device not active":
-        print(f"Device with name {device_name} is offline")
-        return
+        if response[0] == "device not found":
+            print(f"Device with name {device_name} does not exist")
+            return
+        
+        if response[0] == "device not active":
+            print(f"Device with name {device_name} is offline")
+            return
+
+        host = response[1]
+        port = int(response[2])
 
     if not os.path.exists(filename):
         print(f"The file to be sent does not exist!")
         return
 
-    print(f"Sending file to {device_name} at {response[1]}:{response[2]}")
-
-    host = response[1]
-    port = int(response[2])
+    print(f"Sending file to {device_name} at {host}:{port}")
 
     peer_socket = socket(AF_INET, SOCK_DGRAM)
     peer_socket.sendto(username.encode(), (host, port))
@@ -186,6 +251,53 @@ def upload_file(fileID):
     else:
         print(f"There was an error uploading file to the central server...")
 
+# Appends the data samples added to the local file with ID fileID beyond what
+# the server already holds to the copy on the server
+def append_file(fileID):
+    fileID = get_positive_int("APP", "fileID", fileID)
+    
+    if fileID is None:
+        return
+
+    filename = f"{username}-{fileID}.txt"
+    if not os.path.exists(filename):
+        print(f"The file to be appended does not exist!")
+        return
+
+    response = send_to_server(f"app offset\n{fileID}")
+
+    if response == "file not found":
+        print(f"File with ID of {fileID} does not exist on central server")
+        return
+
+    with open(filename, "rb") as f:
+        f.seek(int(response.split()[1]))
+        data = f.read()
+
+    # Only sending complete samples, a partially written one is sent next time
+    data = data[:data.rfind(b"\n") + 1]
+
+    if not data.strip():
+        print(f"There are no new data samples in file {filename}")
+        return
+
+    response = send_to_server(f"app\n{fileID}")
+
+    if response == "file not found":
+        print(f"File with ID of {fileID} does not exist on central server")
+        return
+
+    response = send_to_server(data.decode())
+
+    if response == SERVER_SUCCESS:
+        print(f"{len(data.split())} new data samples of file {filename} have been appended on the central server")
+    elif response == "invalid data":
+        print(f"The data samples of file {filename} must be integers")
+    elif response == "data mismatch":
+        print(f"File {filename} no longer continues the copy on the central server, upload it again with UED")
+    else:
+        print(f"There was an error appending file to the central server...")
+
 # Deletes a file from the server with ID fileID
 def delete_file(fileID):
     fileID = get_positive_int("DTE", "fileID", fileID)
@@ -236,6 +348,35 @@ def get_aed():
     else:
         print(response)
 
+# Subscribes to join and leave events of other active edge devices
+def subscribe_presence():
+    global presence_subscribed
+
+    # Accepting events before the response as the snapshot may arrive first
+    presence_subscribed = True
+    response = send_to_server("subscribe")
+
+    if response == SERVER_SUCCESS:
+        print("Subscribed to active edge device updates")
+    elif response == "already subscribed":
+        print("Already subscribed to active edge device updates")
+    else:
+        presence_subscribed = False
+
+# Unsubscribes from join and leave events of other active edge devices
+def unsubscribe_presence():
+    global presence_subscribed
+
+    # Ignoring events still in flight once unsubscribing
+    presence_subscribed = False
+    response = send_to_server("unsubscribe")
+    known_devices.clear()
+
+    if response == SERVER_SUCCESS:
+        print("Unsubscribed from active edge device updates")
+    elif response == "not subscribed":
+        print("Not subscribed to active edge device updates")
+
 # USER LOGIN SEQUENECE
 # Ensuring username is not empty
 username = ""
@@ -292,6 +433,13 @@ while True:
             print("UED: too many arguments")
         else:
             upload_file(message[1])
+    elif command == "APP":
+        if num_args < 1:
+            print("APP: a fileID is needed to append the data")
+        elif num_args > 1:
+            print("APP: too many arguments")
+        else:
+            append_file(message[1])
     elif command == "DTE":
         if num_args < 1:
             print("DTE: a fileID is needed to delete the file")
@@ -311,6 +459,16 @@ while True:
             print("AED: no arguments expected")
         else:
             get_aed()
+    elif command == "SUB":
+        if num_args > 0:
+            print("SUB: no arguments expected")
+        else:
+            subscribe_presence()
+    elif command == "UNS":
+        if num_args > 0:
+            print("UNS: no arguments expected")
+        else:
+            unsubscribe_presence()
     elif command == "UVF":
         if num_args < 2:
             print("UVF: deviceName or filename is missing!")
@@ -10,7 +10,7 @@
 LOCALHOST = "127.0.0.1"
 BUFFER_SIZE = 2048
 VALID_OPERATIONS = { "sum", "average", "max", "min" }
-PROMPT = "Enter one of the following commands (EDG, UED, SCS, DTE, AED, UVF, OUT): "
+PROMPT = "Enter one of the following commands (EDG, UED, APP, SCS, DTE, AED, SUB, UNS, UVF, OUT): "
 
 CREDENTIALS_FILENAME = "credentials.txt"
 ED_LOG_FILENAME = "edge-device-log.txt"
@@ -19,3 +19,6 @@ DELETION_LOG_FILENAME = "deletion-log.txt"
 
 SERVER_SUCCESS = "success"
 
+
+# First line of every presence event datagram pushed to subscribed devices
+PRESENCE_HEADER = "presence"
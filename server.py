@@ -11,15 +11,18 @@
 """
 
 from socket import *
-from threading import Thread
+from threading import Thread, Condition
 import sys
 from time import time, strftime
 import os
 from constants import   BUFFER_SIZE, LOCALHOST, CREDENTIALS_FILENAME, \
                         ED_LOG_FILENAME, UPLOAD_LOG_FILENAME, \
-                        DELETION_LOG_FILENAME, SERVER_SUCCESS
+                        DELETION_LOG_FILENAME, SERVER_SUCCESS, \
+                        PRESENCE_HEADER
 
 active_edge_devices = []
+presence_subscribers = {}
+file_aggregates = {}
 
 if len(sys.argv) != 3:
     print(f"Usage: {sys.argv[0]} server_port number_of_consecutive_failed_attempts")
@@ -80,6 +83,94 @@ with open(CREDENTIALS_FILENAME, "r") as f:
 def generate_timestamp():
     return strftime("%-d %B %Y %H:%M:%S")
 
+# Returns the lines of a data file holding samples, skipping blank lines
+def sample_lines(lines):
+    return [n for n in lines if n.strip()]
+
+# Converts the lines of a data file to integer samples, skipping blank lines
+def parse_samples(lines):
+    return [int(n) for n in sample_lines(lines)]
+
+# Folds new data samples into the running aggregates of an uploaded file so
+# that computations never need to rescan the file
+def update_aggregates(filename, numeric_data):
+    aggregates = file_aggregates.setdefault(filename, {
+        "count": 0,
+        "sum": 0,
+        "max": None,
+        "min": None
+    })
+
+    if not numeric_data:
+        return
+
+    if aggregates["count"] == 0:
+        aggregates["max"] = max(numeric_data)
+        aggregates["min"] = min(numeric_data)
+    else:
+        aggregates["max"] = max(aggregates["max"], max(numeric_data))
+        aggregates["min"] = min(aggregates["min"], min(numeric_data))
+
+    aggregates["count"] += len(numeric_data)
+    aggregates["sum"] += sum(numeric_data)
+
+# Sender thread pushing presence events to a subscribed edge device over UDP.
+# Pending events are coalesced per username so a slow subscriber only ever
+# holds the latest state of each device, and publishers never block on it
+class PresenceSubscriber(Thread):
+    def __init__(self, username, ip, udp_port):
+        Thread.__init__(self)
+        self.username = username
+        self.address = (ip, int(udp_port))
+        self.pending = {}
+        self.condition = Condition()
+        self.subscribed = True
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+
+    # Queues an event, unless replace is False and a newer event for the same
+    # device is already pending
+    def push(self, event, device, replace=True):
+        with self.condition:
+            if replace or device["username"] not in self.pending:
+                self.pending[device["username"]] = f"{event}; {device['username']}; {device['active_since']}; {device['ip']}; {device['udp_port']}"
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.subscribed = False
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.subscribed and not self.pending:
+                    self.condition.wait()
+
+                if not self.subscribed:
+                    break
+
+                events = list(self.pending.values())
+                self.pending.clear()
+
+            # Packing as many events as fit into each datagram
+            batch = PRESENCE_HEADER
+            for event in events:
+                if len(batch) + len(event) + 1 > BUFFER_SIZE:
+                    self.socket.sendto(batch.encode(), self.address)
+                    batch = PRESENCE_HEADER
+                batch += "\n" + event
+
+            self.socket.sendto(batch.encode(), self.address)
+
+        self.socket.close()
+
+# Notifies every presence subscriber (other than the device itself) that an
+# edge device has joined or left the network
+def publish_presence_event(event, device):
+    for subscriber in list(presence_subscribers.values()):
+        if subscriber.username != device["username"]:
+            subscriber.push(event, device)
+
 # Multi-thread class for client connections
 class ClientThread(Thread):
     def __init__(self, client_address, client_socket):
@@ -93,56 +184,69 @@ class ClientThread(Thread):
     def run(self):
         message = ''
         
-        # Main loop for client connection, listening for client commands
-        while self.clientAlive:
-            data = self.client_socket.recv(BUFFER_SIZE).decode()
+        # Main loop for client connection, listening for client commands, always
+        # stopping the presence subscription however the connection ends
+        try:
+            while self.clientAlive:
+                data = self.client_socket.recv(BUFFER_SIZE).decode()
+
+                if data == '':
+                    if not self.authenticated:
+                        break
 
-            if data == '':
-                if not self.authenticated:
-                    break
+                    self.clientAlive = False
+                    self.print_command_message("OUT")
 
-                self.clientAlive = False
-                self.print_command_message("OUT")
+                    for device in active_edge_devices:
+                        if device.get("username") == self.username:
+                            active_edge_devices.remove(device)
+                            publish_presence_event("leave", device)
+                            break
 
-                for device in active_edge_devices:
-                    if device.get("username") == self.username:
-                        active_edge_devices.remove(device)
-                        break
+                    make_log_file()
 
-                make_log_file()
-
-                print(f"{self.username} exited the edge network")
+                    print(f"{self.username} exited the edge network")
                 
-                break
+                    break
             
-            message = ''
-
-            commands = data.splitlines()
-            command = commands[0]
-
-            if command == 'login request':
-                message = self.process_login(commands[1], commands[2])
-            elif command == 'udp port':
-                message = self.post_login(commands[1])
-            elif not self.authenticated:
-                print(f"\n--- {self.client_address} tried to perform unauthorised action ---")
-                message = 'not authenticated'
-            elif command == 'ued':
-                message = self.save_file_from_client(commands[1])
-            elif command == 'scs':
-                message = self.compute_file_from_server(commands[1], commands[2])
-            elif command == 'dte':
-                message = self.delete_file_from_server(commands[1])
-            elif command == 'aed':
-                message = self.active_devices()
-            elif command == 'device address':
-                message = self.device_address(commands[1])
-            else:
-                print("[received] " + data)
-                print("[sending] message could not be understood")
-                message = 'message could not be understood'
-
-            self.client_socket.send(message.encode())
+                message = ''
+
+                commands = data.splitlines()
+                command = commands[0]
+
+                if command == 'login request':
+                    message = self.process_login(commands[1], commands[2])
+                elif command == 'udp port':
+                    message = self.post_login(commands[1])
+                elif not self.authenticated:
+                    print(f"\n--- {self.client_address} tried to perform unauthorised action ---")
+                    message = 'not authenticated'
+                elif command == 'ued':
+                    message = self.save_file_from_client(commands[1])
+                elif command == 'app offset':
+                    message = self.append_offset(commands[1])
+                elif command == 'app':
+                    message = self.append_file_from_client(commands[1])
+                elif command == 'scs':
+                    message = self.compute_file_from_server(commands[1], commands[2])
+                elif command == 'dte':
+                    message = self.delete_file_from_server(commands[1])
+                elif command == 'aed':
+                    message = self.active_devices()
+                elif command == 'device address':
+                    message = self.device_address(commands[1])
+                elif command == 'subscribe':
+                    message = self.subscribe_presence()
+                elif command == 'unsubscribe':
+                    message = self.unsubscribe_presence()
+                else:
+                    print("[received] " + data)
+                    print("[sending] message could not be understood")
+                    message = 'message could not be understood'
+
+                self.client_socket.send(message.encode())
+        finally:
+            self.remove_presence_subscription()
     
     def print_command_message(self, command):
         print(f"\n--- User {self.username} issued {command} command ---")
@@ -155,6 +259,98 @@ class ClientThread(Thread):
         filename = f"{self.username}-{fileID}.txt"
         self.client_socket.send(SERVER_SUCCESS.encode())
 
+        data = self.receive_data_from_client()
+        data_amount = len(sample_lines(data.splitlines()))
+
+        with open(filename, "w") as f:
+            f.write(data)
+
+        # Non-numeric files get no aggregates, like before they only fail once
+        # a computation is requested on them
+        file_aggregates.pop(filename, None)
+        try:
+            update_aggregates(filename, parse_samples(data.splitlines()))
+        except ValueError:
+            file_aggregates.pop(filename, None)
+        
+        with open(UPLOAD_LOG_FILENAME, "a") as f:
+            f.write(f"{self.username}; {generate_timestamp()}; {fileID}; {data_amount}\n")
+
+        print(f"The file with ID {fileID} has been received and {UPLOAD_LOG_FILENAME} file has been updated")
+
+        return SERVER_SUCCESS
+
+    # Returns the size in bytes of an uploaded file with ID fileID, so that the
+    # client knows where its new data samples start
+    def append_offset(self, fileID):
+        print(f"\n--- {self.username} has requested the uploaded size of file {fileID} ---")
+        filename = f"{self.username}-{fileID}.txt"
+
+        if not os.path.exists(filename):
+            print("File was not found, informing user")
+            return 'file not found'
+
+        size = os.path.getsize(filename)
+        print(f"File {filename} is {size} bytes, sending to user")
+        return f"offset {size}"
+
+    # Appends new data samples from a client to an uploaded file with ID fileID
+    # on the server, updating its aggregates with only the new samples
+    def append_file_from_client(self, fileID):
+        self.print_command_message("APP")
+        filename = f"{self.username}-{fileID}.txt"
+
+        if not os.path.exists(filename):
+            print("File was not found, informing user")
+            return 'file not found'
+
+        print(f"New data samples are being received from edge device {self.username}...")
+        self.client_socket.send(SERVER_SUCCESS.encode())
+
+        data = self.receive_data_from_client()
+
+        try:
+            numeric_data = parse_samples(data.splitlines())
+        except ValueError:
+            print("Received data samples are not integers, informing user")
+            return 'invalid data'
+
+        # The data is stored as is so the file stays a byte for byte prefix of
+        # the client's, so a last sample stored without a newline must be
+        # followed by one instead of being continued
+        with open(filename, "rb") as f:
+            if f.seek(0, os.SEEK_END) > 0 and not data.startswith("\n"):
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    print("Received data samples do not continue the file, informing user")
+                    return 'data mismatch'
+
+        # Files left over from before a server restart have no aggregates yet
+        # and are scanned once here, every later append only costs the new
+        # samples. Non-numeric files uploaded with UED cannot be appended to
+        if filename not in file_aggregates:
+            try:
+                with open(filename, "r") as f:
+                    update_aggregates(filename, parse_samples(f.readlines()))
+            except ValueError:
+                file_aggregates.pop(filename, None)
+                print(f"File {filename} does not contain integer data samples, informing user")
+                return 'invalid data'
+
+        with open(filename, "ab") as f:
+            f.write(data.encode())
+
+        update_aggregates(filename, numeric_data)
+
+        with open(UPLOAD_LOG_FILENAME, "a") as f:
+            f.write(f"{self.username}; {generate_timestamp()}; {fileID}; {len(numeric_data)}\n")
+
+        print(f"{len(numeric_data)} data samples have been appended to the file with ID {fileID} and {UPLOAD_LOG_FILENAME} file has been updated")
+
+        return SERVER_SUCCESS
+
+    # Receives data sent by the client until it stops sending
+    def receive_data_from_client(self):
         data = b''
         chunk = self.client_socket.recv(BUFFER_SIZE)
         while chunk:
@@ -165,19 +361,8 @@ class ClientThread(Thread):
             except timeout:
                 self.client_socket.settimeout(None)
                 break
-        
-        data = data.decode()
-        data_amount = len(data.splitlines())
-
-        with open(filename, "w") as f:
-            f.write(data)
-        
-        with open(UPLOAD_LOG_FILENAME, "a") as f:
-            f.write(f"{self.username}; {generate_timestamp()}; {fileID}; {data_amount}\n")
-
-        print(f"The file with ID {fileID} has been received and {UPLOAD_LOG_FILENAME} file has been updated")
 
-        return SERVER_SUCCESS
+        return data.decode()
     
     # Deletes an uploaded client file with ID fileID from the server
     def delete_file_from_server(self, fileID):
@@ -188,9 +373,10 @@ class ClientThread(Thread):
             print(f"File {filename} was found, deleting...")
             
             with open(filename, "r") as f:
-                data_amount = len(f.readlines())
+                data_amount = len(sample_lines(f.readlines()))
             
             os.remove(filename)
+            file_aggregates.pop(filename, None)
             with open(DELETION_LOG_FILENAME, "a") as f:
                 f.write(f"{self.username}; {generate_timestamp()}; {fileID}; {data_amount}\n")
             
@@ -208,17 +394,23 @@ class ClientThread(Thread):
         
         if os.path.exists(filename):
             print(f"File {filename} was found, computing {computation_operation} operation...")
-            file_data = open(filename, "r").readlines()
-            numeric_data = [int(n) for n in file_data]
+
+            # Only scanning the file if it has no aggregates yet (e.g. it was
+            # uploaded before a server restart)
+            if filename not in file_aggregates:
+                with open(filename, "r") as f:
+                    update_aggregates(filename, parse_samples(f.readlines()))
+
+            aggregates = file_aggregates[filename]
             
             if computation_operation == "sum":
-                result = sum(numeric_data)
+                result = aggregates["sum"]
             elif computation_operation == "average":
-                result = sum(numeric_data) / len(numeric_data)
+                result = aggregates["sum"] / aggregates["count"]
             elif computation_operation == "max":
-                result = max(numeric_data)
+                result = aggregates["max"]
             elif computation_operation == "min":
-                result = min(numeric_data)
+                result = aggregates["min"]
             
             print(f"Computation done, result was {result}")
             return f"result {result}"
@@ -244,6 +436,52 @@ class ClientThread(Thread):
 
         return result
 
+    # Subscribes the edge device to join and leave events of other edge devices,
+    # pushed to its UDP port starting with a snapshot of the active devices
+    def subscribe_presence(self):
+        self.print_command_message("SUB")
+
+        if self.username in presence_subscribers:
+            print(f"{self.username} is already subscribed to presence events")
+            return 'already subscribed'
+
+        subscriber = PresenceSubscriber(self.username, self.client_address[0], self.udp_port)
+        subscriber.setDaemon(True)
+
+        # Registering before taking the snapshot so no join or leave happening
+        # in between is missed, and the snapshot never overrides those events
+        presence_subscribers[self.username] = subscriber
+
+        for device in list(active_edge_devices):
+            if device.get("username") != self.username:
+                subscriber.push("join", device, replace=False)
+
+        subscriber.start()
+
+        print(f"{self.username} has been subscribed to presence events")
+        return SERVER_SUCCESS
+
+    # Unsubscribes the edge device from presence events
+    def unsubscribe_presence(self):
+        self.print_command_message("UNS")
+
+        if not self.remove_presence_subscription():
+            print(f"{self.username} is not subscribed to presence events")
+            return 'not subscribed'
+
+        print(f"{self.username} has been unsubscribed from presence events")
+        return SERVER_SUCCESS
+
+    # Stops the presence subscription of the edge device, if there is one
+    def remove_presence_subscription(self):
+        subscriber = presence_subscribers.pop(self.username, None)
+
+        if subscriber is None:
+            return False
+
+        subscriber.stop()
+        return True
+
     # Processing device address request from another edge device (for peer to 
     # peer communication)
     def device_address(self, device_name):
@@ -266,14 +504,16 @@ class ClientThread(Thread):
         print(f"\n--- UDP port received from {self.username} ---")
         self.udp_port = udp_port
 
-        active_edge_devices.append({
+        device = {
             "username": self.username,
             "active_since": generate_timestamp(),
             "ip": self.client_address[0],
             "udp_port": self.udp_port
-        })
+        }
+        active_edge_devices.append(device)
         
         make_log_file()
+        publish_presence_event("join", device)
 
         return SERVER_SUCCESS
     